@@ -0,0 +1,7 @@
+import os
+
+# main validates these at import time; the tests never reach the real services
+os.environ.setdefault("MISTRAL_API_KEY", "test-key")
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+os.environ.setdefault("SUPABASE_URL", "https://example.supabase.co")
+os.environ.setdefault("SUPABASE_SERVICE_ROLE_KEY", "header.payload.signature")
@@ -1,27 +1,59 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
+from functools import lru_cache
 import os
 from dotenv import load_dotenv
 
 load_dotenv()
 
-# Get database URL from environment variable
-DATABASE_URL = os.getenv("DATABASE_URL")
+Base = declarative_base()
 
-# If DATABASE_URL is not set or contains placeholder values, use SQLite
-if not DATABASE_URL or "[YOUR-PROJECT-REF]" in DATABASE_URL:
-    print("Warning: Using SQLite database for local development")
-    DATABASE_URL = "sqlite:///./thesis.db"
+def get_database_url():
+    # Get database URL from environment variable
+    database_url = os.getenv("DATABASE_URL")
 
-engine = create_engine(DATABASE_URL, connect_args={} if DATABASE_URL.startswith("postgresql") else {"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    # If DATABASE_URL is not set or contains placeholder values, use SQLite
+    if not database_url or "[YOUR-PROJECT-REF]" in database_url:
+        print("Warning: Using SQLite database for local development")
+        database_url = "sqlite:///./thesis.db"
 
-Base = declarative_base()
+    # Point plain URLs at the async drivers
+    if database_url.startswith("postgres://"):
+        database_url = "postgresql+asyncpg://" + database_url[len("postgres://"):]
+    elif database_url.startswith("postgresql://"):
+        database_url = "postgresql+asyncpg://" + database_url[len("postgresql://"):]
+    elif database_url.startswith("sqlite://"):
+        database_url = "sqlite+aiosqlite://" + database_url[len("sqlite://"):]
+
+    return database_url
+
+# The app talks to Supabase over REST; the engine and its pool are only
+# created the first time something actually asks for a session
+@lru_cache(maxsize=1)
+def get_engine():
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    database_url = get_database_url()
+    if database_url.startswith("postgresql"):
+        # Keep the pool small enough for the Supabase session pooler's connection cap,
+        # and drop stale connections before they fail the first query
+        return create_async_engine(
+            database_url,
+            pool_size=3,
+            max_overflow=2,
+            pool_pre_ping=True,
+            pool_recycle=1800,
+            pool_timeout=30,
+            # Supavisor in transaction mode does not support prepared statements
+            connect_args={"statement_cache_size": 0, "prepared_statement_cache_size": 0}
+        )
+    return create_async_engine(database_url, connect_args={"check_same_thread": False})
+
+@lru_cache(maxsize=1)
+def get_sessionmaker():
+    from sqlalchemy.ext.asyncio import async_sessionmaker
+
+    return async_sessionmaker(get_engine(), autoflush=False, expire_on_commit=False)
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with get_sessionmaker()() as db:
         yield db
-    finally:
-        db.close() 
\ No newline at end of file
@@ -1,24 +1,72 @@
-from fastapi import FastAPI, HTTPException, File, UploadFile, Depends, Header
+from fastapi import FastAPI, HTTPException, File, UploadFile, Depends, Header, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi_cache import FastAPICache
+from fastapi_cache.backends.inmemory import InMemoryBackend
+from fastapi_cache.decorator import cache
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
 from datetime import datetime
+from contextlib import asynccontextmanager
+from functools import lru_cache
 import uuid
 import os
+import asyncio
+import hmac
+import hashlib
 from dotenv import load_dotenv
 from supabase_client import supabase
-from services.ocr_service import OCRService
-from services.analysis_service import AnalysisService
-import json
-import re
+from services.ocr_service import get_ocr_service
+from services.analysis_service import get_analysis_service
+from collections import deque
 
 load_dotenv()
 
-app = FastAPI()
+# How long cached GET responses are served before hitting Supabase again
+CACHE_EXPIRE_SECONDS = 30
 
-# Get allowed origins from environment variable or use default
-ALLOWED_ORIGINS = os.getenv("ALLOWED_ORIGINS", "http://localhost:8080").split(",")
+# Largest page the list endpoints return
+# (pages are fetched with .range(offset, offset + limit): postgrest-py's range end is exclusive)
+MAX_PAGE_SIZE = 200
+
+# Stable order for offset pagination: newest first, ties broken by id
+# (passed as one PostgREST order value; chained .order() calls add duplicate params)
+PAGE_ORDER = "created_at.desc,id"
+
+def cache_key_builder(func, namespace="", *, request=None, response=None, args=(), kwargs=None):
+    """Build response cache keys, ignoring credentials so all authorized clients share entries"""
+    kwargs = {k: v for k, v in (kwargs or {}).items() if k != "credentials"}
+    raw_key = f"{func.__module__}:{func.__name__}:{args}:{sorted(kwargs.items())}"
+    # FastAPICache.clear(namespace=...) matches on "<prefix>:<namespace>", so keys must carry the prefix
+    return f"{FastAPICache.get_prefix()}:{namespace}:{hashlib.md5(raw_key.encode()).hexdigest()}"
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    FastAPICache.init(InMemoryBackend(), prefix="thesis-api", key_builder=cache_key_builder)
+    yield
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
+@app.middleware("http")
+async def revalidate_cached_responses(request, call_next):
+    """Keep cached GETs out of browser caches.
+
+    fastapi-cache marks them "max-age=<ttl>", which would let browsers reuse a list for up to
+    CACHE_EXPIRE_SECONDS after a write cleared it server-side. Browsers must revalidate instead;
+    the ETag still lets unchanged responses come back as 304.
+    """
+    response = await call_next(request)
+    if response.headers.get("cache-control", "").startswith("max-age"):
+        response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+# Get allowed origins from environment variable or use default ("a, b" is accepted)
+ALLOWED_ORIGINS = tuple(
+    origin.strip()
+    for origin in os.getenv("ALLOWED_ORIGINS", "http://localhost:8080").split(",")
+    if origin.strip()
+)
 
 # Configure CORS
 app.add_middleware(
@@ -32,20 +80,28 @@ app.add_middleware(
 # Security
 security = HTTPBearer()
 
+# Load the API key once at startup
+_API_KEY = os.getenv("MISTRAL_API_KEY")
+if not _API_KEY:
+    raise ValueError("MISTRAL_API_KEY not set")
+_API_KEY_BYTES = _API_KEY.encode("utf-8")
+
+# Remember recent validation outcomes so repeat clients skip the comparison
+@lru_cache(maxsize=256)
+def _is_valid_api_key(token: str) -> bool:
+    # Constant-time comparison so the check does not leak the key via timing
+    return hmac.compare_digest(token.encode("utf-8"), _API_KEY_BYTES)
+
 def verify_api_key(credentials: HTTPAuthorizationCredentials = Depends(security)):
     """Verify the API key from the Authorization header"""
-    api_key = os.getenv("MISTRAL_API_KEY")
-    if not api_key:
-        raise HTTPException(status_code=500, detail="API key not configured")
-    
-    if credentials.credentials != api_key:
+    if not _is_valid_api_key(credentials.credentials):
         raise HTTPException(status_code=401, detail="Invalid API key")
     
     return credentials
 
 # Initialize services
-ocr_service = OCRService()
-analysis_service = AnalysisService()
+ocr_service = get_ocr_service()
+analysis_service = get_analysis_service()
 
 # Pydantic models
 class ThesisBase(BaseModel):
@@ -64,42 +120,73 @@ class Thesis(ThesisBase):
     class Config:
         from_attributes = True
 
+# Translation table that deletes null bytes and other control characters
+_CTRL_TABLE = dict.fromkeys(list(range(0, 32)) + [0x7F], None)
+
+def _sanitize_str(text):
+    # Clean strings (the common case) need no rewriting
+    if not text or text.isprintable():
+        return text
+    # Remove null bytes and other control characters
+    return text.translate(_CTRL_TABLE)
+
+# Leaf types that serialize to JSON as-is
+_JSON_SCALARS = (int, float, bool, type(None))
+
+# Function to sanitize nested dicts/lists in place, making every leaf JSON-serializable
+def sanitize_for_db_inplace(obj):
+    stack = deque()
+    if isinstance(obj, dict):
+        stack.extend((obj, k) for k in obj)
+    elif isinstance(obj, list):
+        stack.extend((obj, i) for i in range(len(obj)))
+
+    while stack:
+        container, key = stack.pop()
+        value = container[key]
+        if isinstance(value, str):
+            # Only write back slots that actually changed
+            clean = _sanitize_str(value)
+            if clean is not value:
+                container[key] = clean
+        elif isinstance(value, dict):
+            stack.extend((value, k) for k in value)
+        elif isinstance(value, list):
+            stack.extend((value, i) for i in range(len(value)))
+        elif isinstance(value, tuple):
+            container[key] = value = list(value)
+            stack.extend((value, i) for i in range(len(value)))
+        elif not isinstance(value, _JSON_SCALARS):
+            # Anything else (datetimes, UUIDs, ...) is stored as a string
+            container[key] = str(value)
+
+    return obj
+
 # Function to sanitize text for database
 def sanitize_for_db(text):
     if text is None:
         return None
     
     if isinstance(text, str):
-        # Remove null bytes and other control characters
-        return re.sub(r'[\x00-\x1F\x7F]', '', text)
-    elif isinstance(text, dict):
-        # Recursively sanitize dictionary values
-        return {k: sanitize_for_db(v) for k, v in text.items()}
-    elif isinstance(text, list):
-        # Recursively sanitize list items
-        return [sanitize_for_db(item) for item in text]
+        return _sanitize_str(text)
+    elif isinstance(text, (dict, list)):
+        return sanitize_for_db_inplace(text)
     else:
         # Return other types as is
         return text
 
 # Function to prepare data for Supabase
 def prepare_for_supabase(data):
-    # First sanitize all text
-    sanitized = sanitize_for_db(data)
-    
-    # Ensure JSON fields are properly formatted
-    if isinstance(sanitized, dict):
-        # For each field that should be JSON, make sure it's a valid JSON string
-        for key in sanitized:
-            if isinstance(sanitized[key], (dict, list)):
-                try:
-                    # Test if it can be JSON serialized
-                    json.dumps(sanitized[key])
-                except (TypeError, ValueError):
-                    # If it can't be serialized, convert to string
-                    sanitized[key] = str(sanitized[key])
-    
-    return sanitized
+    return sanitize_for_db(data)
+
+# File extensions accepted for paper analysis
+_ALLOWED_EXT = frozenset({"jpg", "jpeg", "png", "pdf"})
+
+# Function to check an upload's extension (case-insensitive)
+def has_allowed_extension(filename):
+    if not filename or "." not in filename:
+        return False
+    return filename.rsplit(".", 1)[-1].lower() in _ALLOWED_EXT
 
 # Routes
 @app.get("/")
@@ -107,9 +194,11 @@ async def root():
     return {"message": "Thesis API is running"}
 
 @app.get("/api/theses/", response_model=List[Thesis])
-async def get_theses():
+@cache(expire=CACHE_EXPIRE_SECONDS, namespace="theses")
+async def get_theses(limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE), offset: int = Query(0, ge=0)):
+    """Get a page of theses (use limit/offset to paginate)"""
     try:
-        response = supabase.table('theses').select('*').execute()
+        response = supabase.table('theses').select('*').order(PAGE_ORDER).range(offset, offset + limit).execute()
         return response.data
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -127,15 +216,17 @@ async def get_thesis(thesis_id: str):
 @app.post("/api/theses/", response_model=Thesis)
 async def create_thesis(thesis: ThesisCreate):
     try:
+        now = datetime.utcnow().isoformat()
         thesis_data = {
             'id': str(uuid.uuid4()),
             'title': thesis.title,
             'content': thesis.content,
             'user_id': 'test-user',  # TODO: Implement proper user authentication
-            'created_at': datetime.utcnow().isoformat(),
-            'updated_at': datetime.utcnow().isoformat()
+            'created_at': now,
+            'updated_at': now
         }
         response = supabase.table('theses').insert(thesis_data).execute()
+        await FastAPICache.clear(namespace="theses")
         return response.data[0]
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -151,6 +242,7 @@ async def update_thesis(thesis_id: str, thesis: ThesisBase):
         response = supabase.table('theses').update(thesis_data).eq('id', thesis_id).execute()
         if not response.data:
             raise HTTPException(status_code=404, detail="Thesis not found")
+        await FastAPICache.clear(namespace="theses")
         return response.data[0]
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -161,6 +253,7 @@ async def delete_thesis(thesis_id: str):
         response = supabase.table('theses').delete().eq('id', thesis_id).execute()
         if not response.data:
             raise HTTPException(status_code=404, detail="Thesis not found")
+        await FastAPICache.clear(namespace="theses")
         return {"message": "Thesis deleted successfully"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -170,22 +263,15 @@ async def analyze_paper(
     file: UploadFile = File(...),
     credentials: HTTPAuthorizationCredentials = Depends(verify_api_key)
 ):
-    if not file.filename.endswith(('.jpg', '.jpeg', '.png', '.pdf')):
+    if not has_allowed_extension(file.filename):
         raise HTTPException(status_code=400, detail="Unsupported file format")
 
     try:
-        # 1. Read file content
-        content = await file.read()
-        
-        # 2. Extract text using OCR service
-        extracted_text = await ocr_service.extract_text(content, file.content_type)
-        # Sanitize extracted text right away
-        extracted_text = sanitize_for_db(extracted_text)
+        # 1-2. Stream the upload into the OCR service to extract text
+        extracted_text = await ocr_service.extract_text_stream(file.file, file.content_type)
         
-        # 3. Run comprehensive analysis using OpenAI
-        paper_analysis = await analysis_service.analyze_paper(extracted_text)
-        citation_analysis = await analysis_service.analyze_citations(extracted_text)
-        gap_analysis = await analysis_service.analyze_research_gaps(extracted_text)
+        # 3. Run comprehensive analysis using OpenAI (independent calls run concurrently)
+        paper_analysis, citation_analysis, gap_analysis = await analysis_service.analyze_all(extracted_text)
         
         # 4. Generate a unique ID for the paper
         paper_id = str(uuid.uuid4())
@@ -216,11 +302,12 @@ async def analyze_paper(
                 "filename": file.filename
             }
             
-            # Sanitize and prepare data for Supabase
+            # Sanitize and prepare data for Supabase (this also cleans the stored text prefix)
             safe_paper_data = prepare_for_supabase(paper_data)
             
             # Insert paper data into the papers table only
             response = supabase.table('papers').insert(safe_paper_data).execute()
+            await FastAPICache.clear(namespace="papers")
             
             print(f"Paper saved to database with ID: {paper_id}")
             
@@ -245,18 +332,24 @@ async def analyze_paper(
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/papers/", response_model=List[Dict[str, Any]])
-async def get_papers(credentials: HTTPAuthorizationCredentials = Depends(verify_api_key)):
-    """Get all analyzed papers with their summaries"""
+@cache(expire=CACHE_EXPIRE_SECONDS, namespace="papers")
+async def get_papers(
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+    offset: int = Query(0, ge=0),
+    credentials: HTTPAuthorizationCredentials = Depends(verify_api_key)
+):
+    """Get a page of analyzed papers with their summaries (use limit/offset to paginate)"""
     try:
         # Only select the metadata fields needed for listing
         response = supabase.table('papers').select(
             'id,title,authors,year_of_publication,paper_type,relevance_score,created_at,updated_at,filename'
-        ).execute()
+        ).order(PAGE_ORDER).range(offset, offset + limit).execute()
         return response.data
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/papers/{paper_id}", response_model=Dict[str, Any])
+@cache(expire=CACHE_EXPIRE_SECONDS, namespace="papers")
 async def get_paper_details(
     paper_id: str,
     credentials: HTTPAuthorizationCredentials = Depends(verify_api_key)
@@ -276,9 +369,11 @@ async def search_papers(
     year: int = None,
     type: str = None,
     min_relevance: int = None,
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+    offset: int = Query(0, ge=0),
     credentials: HTTPAuthorizationCredentials = Depends(verify_api_key)
 ):
-    """Search papers with filters"""
+    """Search papers with filters (use limit/offset to paginate)"""
     try:
         # Only select the metadata fields needed for listing
         query_builder = supabase.table('papers').select(
@@ -294,7 +389,7 @@ async def search_papers(
         if min_relevance:
             query_builder = query_builder.gte('relevance_score', min_relevance)
             
-        response = query_builder.execute()
+        response = query_builder.order(PAGE_ORDER).range(offset, offset + limit).execute()
         return response.data
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -307,11 +402,6 @@ async def update_paper_analysis(
 ):
     """Update an existing paper analysis"""
     try:
-        # Check if paper exists
-        check_response = supabase.table('papers').select('id').eq('id', paper_id).single().execute()
-        if not check_response.data:
-            raise HTTPException(status_code=404, detail="Paper not found")
-        
         # Update timestamp
         update_data["updated_at"] = datetime.now().isoformat()
         
@@ -336,14 +426,19 @@ async def update_paper_analysis(
         # Sanitize and prepare data for Supabase
         safe_update_data = prepare_for_supabase(update_data)
         
-        # Update paper in the papers table
+        # Update paper in the papers table; no returned rows means it doesn't exist
         response = supabase.table('papers').update(safe_update_data).eq('id', paper_id).execute()
+        if not response.data:
+            raise HTTPException(status_code=404, detail="Paper not found")
+        await FastAPICache.clear(namespace="papers")
         
         return {
             "message": "Paper analysis updated successfully",
             "paper_id": paper_id,
-            "updated_data": response.data[0] if response.data else {}
+            "updated_data": response.data[0]
         }
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error updating paper analysis: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -355,15 +450,15 @@ async def delete_paper(
 ):
     """Delete a paper analysis"""
     try:
-        # Check if paper exists
-        check_response = supabase.table('papers').select('id').eq('id', paper_id).single().execute()
-        if not check_response.data:
-            raise HTTPException(status_code=404, detail="Paper not found")
-        
-        # Delete from papers table
+        # Delete from papers table; no returned rows means it doesn't exist
         papers_response = supabase.table('papers').delete().eq('id', paper_id).execute()
+        if not papers_response.data:
+            raise HTTPException(status_code=404, detail="Paper not found")
+        await FastAPICache.clear(namespace="papers")
         
         return {"message": "Paper deleted successfully"}
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error deleting paper: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -383,34 +478,32 @@ async def batch_analyze_papers(
             detail="Maximum 10 files allowed for batch processing"
         )
     
+    # One timestamp for every paper in the batch
+    now = datetime.now().isoformat()
+    
+    # 1. Validate formats
+    supported_files = []
     for file in files:
+        if not has_allowed_extension(file.filename):
+            errors.append({
+                "filename": file.filename,
+                "error": "Unsupported file format"
+            })
+        else:
+            supported_files.append(file)
+    
+    # 2. Extract text for all files in a single batched OCR call, streaming each upload
+    extracted_texts = await ocr_service.extract_text_batch(
+        [(file.file, file.content_type) for file in supported_files]
+    )
+    
+    def _one(file, extracted_text, paper_analysis, citation_analysis, gap_analysis):
         try:
-            # Validate file format
-            if not file.filename.endswith(('.jpg', '.jpeg', '.png', '.pdf')):
-                errors.append({
-                    "filename": file.filename,
-                    "error": "Unsupported file format"
-                })
-                continue
-                
-            # 1. Read file content
-            content = await file.read()
-            
-            # 2. Extract text
-            extracted_text = await ocr_service.extract_text(content, file.content_type)
-            # Sanitize extracted text right away
-            extracted_text = sanitize_for_db(extracted_text)
-            
-            # 3. Run analysis
-            paper_analysis = await analysis_service.analyze_paper(extracted_text)
-            citation_analysis = await analysis_service.analyze_citations(extracted_text)
-            gap_analysis = await analysis_service.analyze_research_gaps(extracted_text)
-            
-            # 4. Generate ID and prepare data
+            # 4. Generate ID
             paper_id = str(uuid.uuid4())
-            now = datetime.now().isoformat()
             
-            # 5. Save to database
+            # 5. Prepare the row; all rows are inserted together below
+            safe_paper_data = None
             try:
                 basic_info = paper_analysis.get("basic_info", {})
                 analysis_info = paper_analysis.get("analysis", {})
@@ -433,29 +526,75 @@ async def batch_analyze_papers(
                     "filename": file.filename
                 }
                 
-                # Sanitize and prepare data for Supabase
+                # Sanitize and prepare data for Supabase (this also cleans the stored text prefix)
                 safe_paper_data = prepare_for_supabase(paper_data)
                 
-                # Insert into papers table only
-                supabase.table('papers').insert(safe_paper_data).execute()
-                
             except Exception as db_error:
                 print(f"Database error for {file.filename}: {str(db_error)}")
                 # Continue processing even if database save fails
             
-            # 6. Add to results
-            results.append({
+            # 6. Build the result entry
+            return {
                 "filename": file.filename,
                 "paper_id": paper_id,
                 "title": basic_info.get("title", "Untitled Paper"),
                 "success": True
-            })
+            }, None, safe_paper_data
             
         except Exception as e:
-            errors.append({
+            return None, {
                 "filename": file.filename,
                 "error": str(e)
+            }, None
+    
+    extracted = []
+    for file, extracted_text in zip(supported_files, extracted_texts):
+        if isinstance(extracted_text, Exception):
+            errors.append({
+                "filename": file.filename,
+                "error": str(extracted_text)
             })
+        else:
+            extracted.append((file, extracted_text))
+    
+    # 3. Run all analyses for all files; paper analyses are packed into as few OpenAI requests as possible
+    try:
+        all_analyses = await analysis_service.analyze_all_batch([text for _, text in extracted])
+    except Exception as e:
+        # Report the failure against every file instead of failing the whole request
+        all_analyses = [e] * len(extracted)
+    
+    outcomes = []
+    for (file, extracted_text), analyses in zip(extracted, all_analyses):
+        if isinstance(analyses, Exception):
+            errors.append({
+                "filename": file.filename,
+                "error": str(analyses)
+            })
+        else:
+            outcomes.append(_one(file, extracted_text, *analyses))
+    to_insert = []
+    for result, error, safe_paper_data in outcomes:
+        if error is not None:
+            errors.append(error)
+        else:
+            results.append(result)
+        if safe_paper_data is not None:
+            to_insert.append(safe_paper_data)
+    
+    # 7. Insert all papers into the papers table in a single request
+    if to_insert:
+        try:
+            supabase.table('papers').insert(to_insert).execute()
+        except Exception as db_error:
+            print(f"Batch insert failed, retrying papers one by one: {str(db_error)}")
+            # Fall back to per-paper inserts so one bad row doesn't lose the batch
+            for safe_paper_data in to_insert:
+                try:
+                    supabase.table('papers').insert(safe_paper_data).execute()
+                except Exception as row_error:
+                    print(f"Database error for {safe_paper_data['filename']}: {str(row_error)}")
+        await FastAPICache.clear(namespace="papers")
     
     return {
         "message": f"Processed {len(results)} papers successfully, {len(errors)} failures",
@@ -502,15 +641,46 @@ async def get_similar_papers(
         if "type" in basic_info:
             keywords.append(basic_info["type"])
         
-        # Get all papers (only metadata fields for comparison)
-        all_papers_response = supabase.table('papers').select(
-            'id,title,authors,year_of_publication,paper_type,relevance_score,created_at,updated_at,filename'
-        ).neq('id', paper_id).execute()
+        source_type = basic_info.get("type")
+        source_year = basic_info.get("year_of_publication", "Unknown")
+        try:
+            source_year_int = int(source_year)
+        except (TypeError, ValueError):
+            source_year_int = None
+        
+        def _within_five_years(query):
+            # year_of_publication is stored as text; four-digit years compare correctly as strings
+            return query.gte('year_of_publication', str(source_year_int - 5)).lte(
+                'year_of_publication', str(source_year_int + 5)
+            )
+        
+        # Let the database pre-filter candidates, strongest match first,
+        # and only widen the search while we have fewer than 'limit' papers
+        candidate_filters = []
+        if source_type and source_year_int is not None:
+            candidate_filters.append(lambda q: _within_five_years(q.eq('paper_type', source_type)))
+        if source_type:
+            candidate_filters.append(lambda q: q.eq('paper_type', source_type))
+        if source_year_int is not None:
+            candidate_filters.append(_within_five_years)
+        candidate_filters.append(lambda q: q)
+        
+        candidates = {}
+        for apply_filter in candidate_filters:
+            # Only metadata fields are needed for comparison
+            query_builder = supabase.table('papers').select(
+                'id,title,authors,year_of_publication,paper_type,relevance_score,created_at,updated_at,filename'
+            ).neq('id', paper_id)
+            response = apply_filter(query_builder).limit(limit * 2).execute()
+            for paper in response.data or []:
+                candidates.setdefault(paper["id"], paper)
+            if len(candidates) >= limit:
+                break
         
-        if not all_papers_response.data:
+        if not candidates:
             return []
         
-        all_papers = all_papers_response.data
+        all_papers = list(candidates.values())
         similar_papers = []
         
         # Simple similarity scoring - can be improved later
@@ -45,4 +45,20 @@ $$ language plpgsql;
 create trigger update_papers_updated_at
     before update on papers
     for each row
-    execute function update_updated_at_column(); 
\ No newline at end of file
+    execute function update_updated_at_column();
+
+-- Cache of LLM analyses keyed by a blake2b hash of the extracted text (plus the model and
+-- prompt version), so re-uploading the same paper does not re-run the analyses
+create table if not exists paper_analyses (
+    content_hash char(64) primary key,
+    paper jsonb,  -- Cached paper analysis
+    citations jsonb,  -- Cached citation analysis
+    gaps jsonb,  -- Cached research gaps analysis
+    created_at timestamp with time zone default now()
+);
+
+-- Private Storage bucket where large images wait while Mistral transcribes them
+-- (the OCR service removes each object afterwards; override the name with OCR_TMP_BUCKET)
+insert into storage.buckets (id, name, public)
+values ('ocr-tmp', 'ocr-tmp', false)
+on conflict (id) do nothing;
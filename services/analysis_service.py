@@ -1,8 +1,302 @@
 from mistralai.client import MistralClient
-from openai import OpenAI
+from openai import AsyncOpenAI, APIConnectionError, BadRequestError, RateLimitError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
 import os
-from typing import Dict, Any
+import orjson
+import logging
+import asyncio
+import hashlib
+from functools import lru_cache
+from typing import Dict, Any, List, Optional, Tuple, Union
 import base64
+import tiktoken
+from supabase_client import get_supabase
+
+logger = logging.getLogger(__name__)
+
+# Limits for packing several papers into one analysis request: the input token budget,
+# and a paper count that keeps the combined JSON answer within the output limit
+BATCH_MAX_TOKENS = 100_000
+BATCH_MAX_PAPERS = 5
+
+# Token budgets for the text sent to the models
+ANALYSIS_MAX_TOKENS = 100_000
+KEY_INFO_MAX_TOKENS = 3000
+
+def _obj(**properties: Dict[str, Any]) -> Dict[str, Any]:
+    """JSON schema for an object in strict mode: every property required, nothing else allowed"""
+    return {"type": "object", "properties": properties, "required": list(properties), "additionalProperties": False}
+
+def _json_schema_format(name: str, schema: Dict[str, Any]) -> Dict[str, Any]:
+    """response_format that makes OpenAI decode straight into the given schema"""
+    return {"type": "json_schema", "json_schema": {"name": name, "schema": schema, "strict": True}}
+
+# Field guidance goes in each property's description, since the prompts no longer spell out the structure
+def _text(description: str) -> Dict[str, Any]:
+    return {"type": "string", "description": description}
+
+def _texts(description: str) -> Dict[str, Any]:
+    return {"type": "array", "items": {"type": "string"}, "description": description}
+
+def _count(description: str) -> Dict[str, Any]:
+    return {"type": "integer", "description": description}
+
+def _score(description: str) -> Dict[str, Any]:
+    return {"type": "integer", "description": f"{description}, from 1 to 10"}
+
+_PAPER_SCHEMA = _obj(
+    basic_info=_obj(
+        title=_text("full title of the paper"),
+        authors=_texts("list of all authors"),
+        year_of_publication=_text("year (extract from text)"),
+        type=_text("type of paper (e.g., research article, review, case study)"),
+        link_to_article=_text("URL if mentioned in the text")
+    ),
+    analysis=_obj(
+        relevance_score=_score("relevance to the field"),
+        relevance_explanation=_text("detailed explanation of relevance to field"),
+        main_findings=_texts("list of key findings and conclusions"),
+        methods=_obj(
+            methodology_type=_text("primary methodology used"),
+            specific_methods=_texts("list of specific methods used"),
+            data_collection=_text("description of data collection process"),
+            analysis_techniques=_texts("list of analysis techniques")
+        ),
+        gaps_and_limitations=_obj(
+            identified_gaps=_texts("list of research gaps"),
+            limitations=_texts("list of study limitations"),
+            methodology_limitations=_texts("specific limitations in methods")
+        )
+    ),
+    quality_metrics=_obj(
+        methodology_score=_score("quality of the methodology"),
+        data_quality_score=_score("quality of the data"),
+        innovation_score=_score("innovation"),
+        impact_score=_score("expected impact")
+    ),
+    meta_info=_obj(
+        reviewer_initials=_text("extract or mark as N/A"),
+        review_date=_text("current date"),
+        additional_notes=_texts("any other important observations")
+    )
+)
+
+_CITATION_SCHEMA = _obj(
+    citation_metrics=_obj(
+        total_citations=_count("total number of citations"),
+        unique_sources=_count("number of unique sources"),
+        year_range=_text("oldest to newest citation"),
+        most_cited_authors=_texts("list of frequently cited authors")
+    ),
+    citation_quality=_obj(
+        recency=_obj(
+            score=_score("recency of the citations"),
+            analysis=_text("assessment of citation dates"),
+            recent_citations=_count("number of citations from last 5 years")
+        ),
+        authority=_obj(
+            score=_score("authority of the cited sources"),
+            key_references=_texts("most important references"),
+            seminal_works=_texts("foundational papers cited")
+        ),
+        diversity=_obj(
+            score=_score("diversity of the cited sources"),
+            source_types=_texts("distribution of source types"),
+            field_coverage=_text("breadth of field coverage")
+        )
+    ),
+    recommendations=_obj(
+        missing_citations=_texts("suggested additional citations"),
+        citation_improvements=_texts("ways to improve citation quality"),
+        key_papers_to_add=_texts("specific papers to consider adding")
+    )
+)
+
+_GAPS_SCHEMA = _obj(
+    research_gaps=_obj(
+        identified_gaps=_texts("list of gaps"),
+        priority_levels=_obj(
+            high_priority=_texts("urgent gaps to address"),
+            medium_priority=_texts("important but less urgent gaps"),
+            low_priority=_texts("gaps that could be addressed")
+        ),
+        gap_categories=_obj(
+            methodological=_texts("gaps in methods"),
+            theoretical=_texts("gaps in theory"),
+            empirical=_texts("gaps in data/evidence")
+        )
+    ),
+    future_directions=_obj(
+        short_term=_texts("immediate research opportunities"),
+        long_term=_texts("future research directions"),
+        interdisciplinary=_texts("cross-field opportunities")
+    ),
+    implementation=_obj(
+        required_resources=_texts("needed resources"),
+        potential_challenges=_texts("anticipated challenges"),
+        suggested_approaches=_texts("recommended methods"),
+        collaboration_needs=_texts("required expertise")
+    )
+)
+
+_PAPER_FORMAT = _json_schema_format("paper_analysis", _PAPER_SCHEMA)
+_CITATION_FORMAT = _json_schema_format("citation_analysis", _CITATION_SCHEMA)
+_GAPS_FORMAT = _json_schema_format("gap_analysis", _GAPS_SCHEMA)
+_PAPER_BATCH_FORMAT = _json_schema_format("paper_analyses", _obj(results={"type": "array", "items": _PAPER_SCHEMA}))
+
+# The response schemas carry the structure, so the system prompts only set the task
+_PAPER_SYSTEM = "You are an expert academic paper analyzer."
+_CITATION_SYSTEM = "Analyze the citations and references in this paper."
+_GAPS_SYSTEM = "Identify research gaps and opportunities in this paper."
+_PAPER_BATCH_SYSTEM = "You are an expert academic paper analyzer; return one result per \"### PAPER i\" section, in order."
+
+# Returned when a paper analysis response cannot be parsed. Kept pre-serialized:
+# loading a fresh copy is cheaper than deep-copying the nested dict
+_FALLBACK_PAPER_JSON = orjson.dumps({
+    "basic_info": {
+        "title": "Analysis of document",
+        "authors": ["Not extracted"],
+        "year_of_publication": "Not extracted",
+        "type": "Not extracted",
+        "link_to_article": "Not found"
+    },
+    "analysis": {
+        "relevance_score": 5,
+        "relevance_explanation": "Relevance could not be determined",
+        "main_findings": ["Could not extract findings from text"],
+        "methods": {
+            "methodology_type": "Not specified",
+            "specific_methods": ["Not extracted"],
+            "data_collection": "Not specified",
+            "analysis_techniques": ["Not extracted"]
+        },
+        "gaps_and_limitations": {
+            "identified_gaps": ["Not extracted"],
+            "limitations": ["Not extracted"],
+            "methodology_limitations": ["Not extracted"]
+        }
+    },
+    "quality_metrics": {
+        "methodology_score": 5,
+        "data_quality_score": 5,
+        "innovation_score": 5,
+        "impact_score": 5
+    },
+    "meta_info": {
+        "reviewer_initials": "N/A",
+        "review_date": "Current",
+        "additional_notes": ["Analysis failed to produce structured output"]
+    }
+})
+
+# Returned when a citation analysis response cannot be parsed
+_FALLBACK_CITATIONS_JSON = orjson.dumps({
+    "citation_metrics": {
+        "total_citations": 0,
+        "unique_sources": 0,
+        "year_range": "Not determined",
+        "most_cited_authors": ["Not extracted"]
+    },
+    "citation_quality": {
+        "recency": {
+            "score": 5,
+            "analysis": "Citation dates could not be determined",
+            "recent_citations": 0
+        },
+        "authority": {
+            "score": 5,
+            "key_references": ["Not determined"],
+            "seminal_works": ["Not determined"]
+        },
+        "diversity": {
+            "score": 5,
+            "source_types": ["Not determined"],
+            "field_coverage": "Not determined"
+        }
+    },
+    "recommendations": {
+        "missing_citations": ["Not determined"],
+        "citation_improvements": ["Not determined"],
+        "key_papers_to_add": ["Not determined"]
+    }
+})
+
+# Returned when a gap analysis response cannot be parsed
+_FALLBACK_GAPS_JSON = orjson.dumps({
+    "research_gaps": {
+        "identified_gaps": ["Not extracted"],
+        "priority_levels": {
+            "high_priority": ["Not determined"],
+            "medium_priority": ["Not determined"],
+            "low_priority": ["Not determined"]
+        },
+        "gap_categories": {
+            "methodological": ["Not determined"],
+            "theoretical": ["Not determined"],
+            "empirical": ["Not determined"]
+        }
+    },
+    "future_directions": {
+        "short_term": ["Not determined"],
+        "long_term": ["Not determined"],
+        "interdisciplinary": ["Not determined"]
+    },
+    "implementation": {
+        "required_resources": ["Not determined"],
+        "potential_challenges": ["Not determined"],
+        "suggested_approaches": ["Not determined"],
+        "collaboration_needs": ["Not determined"]
+    }
+})
+
+# Columns of the paper_analyses table, one per analysis, and their fallbacks
+_ANALYSIS_COLUMNS = ("paper", "citations", "gaps")
+_FALLBACKS_JSON = {"paper": _FALLBACK_PAPER_JSON, "citations": _FALLBACK_CITATIONS_JSON, "gaps": _FALLBACK_GAPS_JSON}
+
+@lru_cache(maxsize=1)
+def _get_encoding():
+    # Building the BPE tables is slow (and may download them), so do it once, on first use
+    return tiktoken.encoding_for_model("gpt-4o")
+
+def _truncate(text: str, max_tokens: int) -> str:
+    """Cut text to at most max_tokens tokens"""
+    encoding = _get_encoding()
+    # Papers about language models quote tokens like <|endoftext|>; encode them as plain text
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens])
+
+def _prepare_prompts(texts: List[str]) -> List[Union[Tuple[str, int], Exception]]:
+    """Truncate each text to ANALYSIS_MAX_TOKENS, returning it with its token count (runs in a thread).
+
+    A text that cannot be tokenized yields its exception instead.
+    """
+    prompts = []
+    for text in texts:
+        try:
+            encoding = _get_encoding()
+            token_ids = encoding.encode(text, disallowed_special=())[:ANALYSIS_MAX_TOKENS]
+            tokens = len(token_ids)
+            prompts.append((text if tokens < ANALYSIS_MAX_TOKENS else encoding.decode(token_ids), tokens))
+        except Exception as e:
+            prompts.append(e)
+    return prompts
+
+# Bump when the analysis prompts change, so analyses made with the old wording are not served
+ANALYSIS_CACHE_VERSION = 2
+
+# Schemas and system prompts are folded into the cache key as well, so changing them needs no bump
+_PROMPT_FINGERPRINT = hashlib.blake2b(orjson.dumps([
+    _PAPER_FORMAT, _CITATION_FORMAT, _GAPS_FORMAT, _PAPER_BATCH_FORMAT,
+    _PAPER_SYSTEM, _CITATION_SYSTEM, _GAPS_SYSTEM, _PAPER_BATCH_SYSTEM
+]), digest_size=8).hexdigest()
+
+def _content_hash(text: str, model: str) -> str:
+    """Key for the paper_analyses cache table: the text plus everything that shapes its analyses"""
+    key = hashlib.blake2b(f"{ANALYSIS_CACHE_VERSION}:{_PROMPT_FINGERPRINT}:{model}\0".encode("utf-8"), digest_size=32)
+    key.update(text.encode("utf-8"))
+    return key.hexdigest()
 
 class AnalysisService:
     def __init__(self):
@@ -15,9 +309,57 @@ class AnalysisService:
             raise ValueError("OPENAI_API_KEY not set")
             
         self.mistral_client = MistralClient(api_key=mistral_api_key)
-        self.openai_client = OpenAI(api_key=openai_api_key)
+        # Retries are left to tenacity in _create_completion, so backoff sleeps don't hold a semaphore slot
+        self.openai_client = AsyncOpenAI(api_key=openai_api_key, max_retries=0)
         self.model = "mistral-large-latest"
         self.openai_model = "gpt-4o"
+        # Extraction/transcription needs no reasoning; route it to the faster, cheaper models
+        self.extract_model = "mistral-small-latest"
+        self.openai_extract_model = "gpt-4o-mini"
+
+        # Cap in-flight requests per provider to stay under their rate limits
+        self._openai_sem = asyncio.Semaphore(int(os.getenv("OPENAI_CONCURRENCY", "8")))
+        self._mistral_sem = asyncio.Semaphore(4)
+
+    @retry(
+        wait=wait_random_exponential(min=1, max=60),
+        stop=stop_after_attempt(6),
+        retry=retry_if_exception_type((RateLimitError, APIConnectionError)),
+        reraise=True
+    )
+    async def _create_completion(self, **kwargs):
+        """Create an OpenAI chat completion, throttled and retried with backoff on rate limits"""
+        async with self._openai_sem:
+            return await self.openai_client.chat.completions.create(**kwargs)
+
+    async def _get_cached_analysis(self, column: str, content_hash: str) -> Optional[Dict[str, Any]]:
+        """Return a previously stored analysis of the same text, if any"""
+        return (await self._get_cached_analyses(content_hash, (column,))).get(column)
+
+    async def _get_cached_analyses(self, content_hash: str, columns: Tuple[str, ...]) -> Dict[str, Any]:
+        """Return the stored analyses of the same text, column by column, in one lookup"""
+        try:
+            response = await asyncio.to_thread(
+                lambda: get_supabase().table("paper_analyses").select(",".join(columns)).eq("content_hash", content_hash).maybe_single().execute()
+            )
+            if response and response.data:
+                return response.data
+        except Exception as e:
+            logger.warning("Analysis cache lookup error: %s", e)
+        return {}
+
+    async def _store_analysis(self, column: str, content_hash: str, analysis: Dict[str, Any]) -> None:
+        """Store an analysis so the same text is never sent to OpenAI twice"""
+        await self._store_analyses(content_hash, {column: analysis})
+
+    async def _store_analyses(self, content_hash: str, analyses: Dict[str, Any]) -> None:
+        """Store several analyses of the same text in one upsert"""
+        try:
+            await asyncio.to_thread(
+                lambda: get_supabase().table("paper_analyses").upsert({"content_hash": content_hash, **analyses}).execute()
+            )
+        except Exception as e:
+            logger.warning("Analysis cache store error: %s", e)
 
     async def extract_key_info(self, text: str) -> Dict[str, Any]:
         """Use Mistral to extract key information from text"""
@@ -35,15 +377,18 @@ class AnalysisService:
                 - keywords: List of 5-10 key terms or concepts
                 - main_points: List of 3-5 main arguments or findings
                 
-                Text to analyze: {text[:4000]}  # Limit text length for API
+                Text to analyze: {_truncate(text, KEY_INFO_MAX_TOKENS)}
                 """
             }
         ]
         
-        response = self.mistral_client.chat.complete(
-            model=self.model,
-            messages=messages
-        )
+        async with self._mistral_sem:
+            # The Mistral client is synchronous; keep it off the event loop
+            response = await asyncio.to_thread(
+                self.mistral_client.chat.complete,
+                model=self.extract_model,
+                messages=messages
+            )
         return response.choices[0].message.content
 
     async def analyze_content(self, extracted_info: Dict[str, Any]) -> Dict[str, Any]:
@@ -57,10 +402,10 @@ class AnalysisService:
         5. Academic impact score (1-10)
         
         Content to analyze:
-        {str(extracted_info)}
+        {_truncate(str(extracted_info), ANALYSIS_MAX_TOKENS)}
         """
         
-        response = self.openai_client.chat.completions.create(
+        response = await self._create_completion(
             model=self.openai_model,
             messages=[
                 {"role": "system", "content": "You are an expert academic analyst."},
@@ -71,300 +416,291 @@ class AnalysisService:
 
     async def analyze_paper(self, text_content: str) -> Dict[str, Any]:
         """Comprehensive academic paper analysis using GPT-4o"""
+        content_hash = _content_hash(text_content, self.openai_model)
+        cached = await self._get_cached_analysis("paper", content_hash)
+        if cached is not None:
+            return cached
+        
+        prompt_text = await asyncio.to_thread(_truncate, text_content, ANALYSIS_MAX_TOKENS)
+        analysis = await self._request_paper_analysis(prompt_text)
+        if analysis is None:
+            return orjson.loads(_FALLBACK_PAPER_JSON)
+        await self._store_analysis("paper", content_hash, analysis)
+        return analysis
+
+    async def _request_paper_analysis(self, prompt_text: str) -> Optional[Dict[str, Any]]:
+        """Ask GPT-4o for a paper analysis of already truncated text; None if the reply cannot be parsed"""
         try:
-            completion = self.openai_client.chat.completions.create(
+            completion = await self._create_completion(
                 model=self.openai_model,
+                response_format=_PAPER_FORMAT,
                 messages=[
-                    {"role": "system", "content": """You are an expert academic paper analyzer. 
-                    Analyze the paper and provide a detailed JSON response with the following structure:
-                    {
-                        "basic_info": {
-                            "title": "full title of the paper",
-                            "authors": ["list of all authors"],
-                            "year_of_publication": "year (extract from text)",
-                            "type": "type of paper (e.g., research article, review, case study)",
-                            "link_to_article": "URL if mentioned in the text"
-                        },
-                        "analysis": {
-                            "relevance_score": 1-10,
-                            "relevance_explanation": "detailed explanation of relevance to field",
-                            "main_findings": [
-                                "list of key findings and conclusions"
-                            ],
-                            "methods": {
-                                "methodology_type": "primary methodology used",
-                                "specific_methods": ["list of specific methods used"],
-                                "data_collection": "description of data collection process",
-                                "analysis_techniques": ["list of analysis techniques"]
-                            },
-                            "gaps_and_limitations": {
-                                "identified_gaps": ["list of research gaps"],
-                                "limitations": ["list of study limitations"],
-                                "methodology_limitations": ["specific limitations in methods"]
-                            }
-                        },
-                        "quality_metrics": {
-                            "methodology_score": 1-10,
-                            "data_quality_score": 1-10,
-                            "innovation_score": 1-10,
-                            "impact_score": 1-10
-                        },
-                        "meta_info": {
-                            "reviewer_initials": "extract or mark as N/A",
-                            "review_date": "current date",
-                            "additional_notes": ["any other important observations"]
-                        }
-                    }"""},
-                    {"role": "user", "content": f"Analyze this academic paper and provide a detailed assessment. Extract all available information for each field. If any field cannot be determined from the text, mark it as 'Not specified in text':\n\n{text_content}"}
+                    {"role": "system", "content": _PAPER_SYSTEM},
+                    {"role": "user", "content": f"Analyze this academic paper and provide a detailed assessment. Extract all available information for each field. If any field cannot be determined from the text, mark it as 'Not specified in text':\n\n{prompt_text}"}
                 ]
             )
             
             content = completion.choices[0].message.content
-            print(f"Paper analysis raw response: {content}")
+            logger.debug("Paper analysis raw response: %s", content)
             
             # Try to parse the response as JSON
-            import json
             try:
-                # Check if the response is already JSON
-                return json.loads(content)
-            except json.JSONDecodeError:
-                # If not, try to extract JSON from markdown or text
-                if "```json" in content:
-                    # Extract JSON from markdown code block
-                    json_str = content.split("```json")[1].split("```")[0].strip()
-                    return json.loads(json_str)
-                else:
-                    # Create a fallback structure
-                    print("Could not parse JSON from paper analysis response")
-                    return {
-                        "basic_info": {
-                            "title": "Analysis of document",
-                            "authors": ["Not extracted"],
-                            "year_of_publication": "Not extracted",
-                            "type": "Not extracted",
-                            "link_to_article": "Not found"
-                        },
-                        "analysis": {
-                            "relevance_score": 5,
-                            "relevance_explanation": "Relevance could not be determined",
-                            "main_findings": ["Could not extract findings from text"],
-                            "methods": {
-                                "methodology_type": "Not specified",
-                                "specific_methods": ["Not extracted"],
-                                "data_collection": "Not specified",
-                                "analysis_techniques": ["Not extracted"]
-                            },
-                            "gaps_and_limitations": {
-                                "identified_gaps": ["Not extracted"],
-                                "limitations": ["Not extracted"],
-                                "methodology_limitations": ["Not extracted"]
-                            }
-                        },
-                        "quality_metrics": {
-                            "methodology_score": 5,
-                            "data_quality_score": 5,
-                            "innovation_score": 5,
-                            "impact_score": 5
-                        },
-                        "meta_info": {
-                            "reviewer_initials": "N/A",
-                            "review_date": "Current",
-                            "additional_notes": ["Analysis failed to produce structured output"]
-                        }
-                    }
+                return orjson.loads(content)
+            except orjson.JSONDecodeError:
+                logger.warning("Could not parse JSON from paper analysis response")
+                return None
 
         except Exception as e:
-            print(f"OpenAI analysis error: {str(e)}")
+            logger.error("OpenAI analysis error: %s", e)
             raise Exception(f"OpenAI analysis error: {str(e)}")
 
     async def analyze_citations(self, text_content: str) -> Dict[str, Any]:
         """Analyze citation quality and academic references"""
+        content_hash = _content_hash(text_content, self.openai_model)
+        cached = await self._get_cached_analysis("citations", content_hash)
+        if cached is not None:
+            return cached
+        
+        prompt_text = await asyncio.to_thread(_truncate, text_content, ANALYSIS_MAX_TOKENS)
+        analysis = await self._request_citation_analysis(prompt_text)
+        if analysis is None:
+            return orjson.loads(_FALLBACK_CITATIONS_JSON)
+        await self._store_analysis("citations", content_hash, analysis)
+        return analysis
+
+    async def _request_citation_analysis(self, prompt_text: str) -> Optional[Dict[str, Any]]:
+        """Ask GPT-4o for a citation analysis of already truncated text; None if the reply cannot be parsed"""
         try:
-            completion = self.openai_client.chat.completions.create(
+            completion = await self._create_completion(
                 model=self.openai_model,
+                response_format=_CITATION_FORMAT,
                 messages=[
-                    {"role": "system", "content": """Analyze the citations and references in this paper.
-                    Provide a JSON response with:
-                    {
-                        "citation_metrics": {
-                            "total_citations": number,
-                            "unique_sources": number,
-                            "year_range": "oldest to newest citation",
-                            "most_cited_authors": ["list of frequently cited authors"]
-                        },
-                        "citation_quality": {
-                            "recency": {
-                                "score": 1-10,
-                                "analysis": "assessment of citation dates",
-                                "recent_citations": "number of citations from last 5 years"
-                            },
-                            "authority": {
-                                "score": 1-10,
-                                "key_references": ["most important references"],
-                                "seminal_works": ["foundational papers cited"]
-                            },
-                            "diversity": {
-                                "score": 1-10,
-                                "source_types": ["distribution of source types"],
-                                "field_coverage": "breadth of field coverage"
-                            }
-                        },
-                        "recommendations": {
-                            "missing_citations": ["suggested additional citations"],
-                            "citation_improvements": ["ways to improve citation quality"],
-                            "key_papers_to_add": ["specific papers to consider adding"]
-                        }
-                    }"""},
-                    {"role": "user", "content": f"Analyze the citations in this paper:\n\n{text_content}"}
+                    {"role": "system", "content": _CITATION_SYSTEM},
+                    {"role": "user", "content": f"Analyze the citations in this paper:\n\n{prompt_text}"}
                 ]
             )
             
             content = completion.choices[0].message.content
-            print(f"Citation analysis raw response: {content}")
+            logger.debug("Citation analysis raw response: %s", content)
             
             # Try to parse the response as JSON
-            import json
             try:
-                # Check if the response is already JSON
-                return json.loads(content)
-            except json.JSONDecodeError:
-                # If not, try to extract JSON from markdown or text
-                if "```json" in content:
-                    # Extract JSON from markdown code block
-                    json_str = content.split("```json")[1].split("```")[0].strip()
-                    return json.loads(json_str)
-                else:
-                    # Create a fallback structure
-                    print("Could not parse JSON from citation analysis response")
-                    return {
-                        "citation_metrics": {
-                            "total_citations": 0,
-                            "unique_sources": 0,
-                            "year_range": "Not determined",
-                            "most_cited_authors": ["Not extracted"]
-                        },
-                        "citation_quality": {
-                            "recency": {
-                                "score": 5,
-                                "analysis": "Citation dates could not be determined",
-                                "recent_citations": 0
-                            },
-                            "authority": {
-                                "score": 5,
-                                "key_references": ["Not determined"],
-                                "seminal_works": ["Not determined"]
-                            },
-                            "diversity": {
-                                "score": 5,
-                                "source_types": ["Not determined"],
-                                "field_coverage": "Not determined"
-                            }
-                        },
-                        "recommendations": {
-                            "missing_citations": ["Not determined"],
-                            "citation_improvements": ["Not determined"],
-                            "key_papers_to_add": ["Not determined"]
-                        }
-                    }
+                return orjson.loads(content)
+            except orjson.JSONDecodeError:
+                logger.warning("Could not parse JSON from citation analysis response")
+                return None
 
         except Exception as e:
-            print(f"OpenAI citation analysis error: {str(e)}")
+            logger.error("OpenAI citation analysis error: %s", e)
             raise Exception(f"OpenAI citation analysis error: {str(e)}")
 
     async def analyze_research_gaps(self, text_content: str) -> Dict[str, Any]:
         """Identify research gaps and future opportunities"""
+        content_hash = _content_hash(text_content, self.openai_model)
+        cached = await self._get_cached_analysis("gaps", content_hash)
+        if cached is not None:
+            return cached
+        
+        prompt_text = await asyncio.to_thread(_truncate, text_content, ANALYSIS_MAX_TOKENS)
+        analysis = await self._request_gap_analysis(prompt_text)
+        if analysis is None:
+            return orjson.loads(_FALLBACK_GAPS_JSON)
+        await self._store_analysis("gaps", content_hash, analysis)
+        return analysis
+
+    async def _request_gap_analysis(self, prompt_text: str) -> Optional[Dict[str, Any]]:
+        """Ask GPT-4o for a research gap analysis of already truncated text; None if the reply cannot be parsed"""
         try:
-            completion = self.openai_client.chat.completions.create(
+            completion = await self._create_completion(
                 model=self.openai_model,
+                response_format=_GAPS_FORMAT,
                 messages=[
-                    {"role": "system", "content": """Identify research gaps and opportunities.
-                    Provide a JSON response with:
-                    {
-                        "research_gaps": {
-                            "identified_gaps": ["list of gaps"],
-                            "priority_levels": {
-                                "high_priority": ["urgent gaps to address"],
-                                "medium_priority": ["important but less urgent gaps"],
-                                "low_priority": ["gaps that could be addressed"]
-                            },
-                            "gap_categories": {
-                                "methodological": ["gaps in methods"],
-                                "theoretical": ["gaps in theory"],
-                                "empirical": ["gaps in data/evidence"]
-                            }
-                        },
-                        "future_directions": {
-                            "short_term": ["immediate research opportunities"],
-                            "long_term": ["future research directions"],
-                            "interdisciplinary": ["cross-field opportunities"]
-                        },
-                        "implementation": {
-                            "required_resources": ["needed resources"],
-                            "potential_challenges": ["anticipated challenges"],
-                            "suggested_approaches": ["recommended methods"],
-                            "collaboration_needs": ["required expertise"]
-                        }
-                    }"""},
-                    {"role": "user", "content": f"Identify research gaps in this paper:\n\n{text_content}"}
+                    {"role": "system", "content": _GAPS_SYSTEM},
+                    {"role": "user", "content": f"Identify research gaps in this paper:\n\n{prompt_text}"}
                 ]
             )
             
             content = completion.choices[0].message.content
-            print(f"Gap analysis raw response: {content}")
+            logger.debug("Gap analysis raw response: %s", content)
             
             # Try to parse the response as JSON
-            import json
             try:
-                # Check if the response is already JSON
-                return json.loads(content)
-            except json.JSONDecodeError:
-                # If not, try to extract JSON from markdown or text
-                if "```json" in content:
-                    # Extract JSON from markdown code block
-                    json_str = content.split("```json")[1].split("```")[0].strip()
-                    return json.loads(json_str)
-                else:
-                    # Create a fallback structure
-                    print("Could not parse JSON from gap analysis response")
-                    return {
-                        "research_gaps": {
-                            "identified_gaps": ["Not extracted"],
-                            "priority_levels": {
-                                "high_priority": ["Not determined"],
-                                "medium_priority": ["Not determined"],
-                                "low_priority": ["Not determined"]
-                            },
-                            "gap_categories": {
-                                "methodological": ["Not determined"],
-                                "theoretical": ["Not determined"],
-                                "empirical": ["Not determined"]
-                            }
-                        },
-                        "future_directions": {
-                            "short_term": ["Not determined"],
-                            "long_term": ["Not determined"],
-                            "interdisciplinary": ["Not determined"]
-                        },
-                        "implementation": {
-                            "required_resources": ["Not determined"],
-                            "potential_challenges": ["Not determined"],
-                            "suggested_approaches": ["Not determined"],
-                            "collaboration_needs": ["Not determined"]
-                        }
-                    }
+                return orjson.loads(content)
+            except orjson.JSONDecodeError:
+                logger.warning("Could not parse JSON from gap analysis response")
+                return None
 
         except Exception as e:
-            print(f"OpenAI research gap analysis error: {str(e)}")
+            logger.error("OpenAI research gap analysis error: %s", e)
             raise Exception(f"OpenAI research gap analysis error: {str(e)}")
 
+    async def analyze_all_batch(self, texts: List[str]) -> List[Union[Tuple[Dict[str, Any], Dict[str, Any], Dict[str, Any]], Exception]]:
+        """Run analyze_all over several texts, packing the paper analyses into as few requests as possible.
+
+        Each text is tokenized at most once, off the event loop. Results come back in input order;
+        a paper whose analyses failed yields the exception instead.
+        """
+        results: List[Any] = [None] * len(texts)
+        content_hashes = [_content_hash(text, self.openai_model) for text in texts]
+        
+        # Serve what we can from the analysis cache, one lookup per paper
+        analyses = await asyncio.gather(*[self._get_cached_analyses(h, _ANALYSIS_COLUMNS) for h in content_hashes])
+        needed = [i for i in range(len(texts)) if any(analyses[i].get(column) is None for column in _ANALYSIS_COLUMNS)]
+        
+        prompts = {}
+        for i, prompt in zip(needed, await asyncio.to_thread(_prepare_prompts, [texts[i] for i in needed])):
+            if isinstance(prompt, Exception):
+                # One paper that cannot be tokenized must not sink the rest of the batch
+                results[i] = Exception(f"OpenAI analysis error: {str(prompt)}")
+            else:
+                prompts[i] = prompt
+        
+        # Paper analyses share packed requests; citations and gaps take one request each
+        requests = self._analysis_requests()
+        paper_pending = [i for i in prompts if analyses[i].get("paper") is None]
+        other_pending = [(i, column) for i in prompts for column in ("citations", "gaps") if analyses[i].get(column) is None]
+        paper_results, other_results = await asyncio.gather(
+            self._request_paper_analyses([prompts[i] for i in paper_pending]),
+            asyncio.gather(*[requests[column](prompts[i][0]) for i, column in other_pending], return_exceptions=True)
+        )
+        
+        fresh: Dict[int, Dict[str, Any]] = {i: {} for i in prompts}
+        for i, analysis in zip(paper_pending, paper_results):
+            fresh[i]["paper"] = analysis
+        for (i, column), analysis in zip(other_pending, other_results):
+            fresh[i][column] = analysis
+        
+        # One upsert per paper for everything that parsed
+        parsed = {
+            i: {column: analysis for column, analysis in columns.items() if isinstance(analysis, dict)}
+            for i, columns in fresh.items()
+        }
+        await asyncio.gather(*[self._store_analyses(content_hashes[i], columns) for i, columns in parsed.items() if columns])
+        
+        for i, columns in fresh.items():
+            failure = next((analysis for analysis in columns.values() if isinstance(analysis, Exception)), None)
+            if failure is not None:
+                results[i] = failure
+                continue
+            for column, analysis in columns.items():
+                analyses[i][column] = orjson.loads(_FALLBACKS_JSON[column]) if analysis is None else analysis
+        
+        for i, columns in enumerate(analyses):
+            if results[i] is None:
+                results[i] = (columns["paper"], columns["citations"], columns["gaps"])
+        return results
+
+    async def _request_paper_analyses(self, prompts: List[Tuple[str, int]]) -> List[Union[Optional[Dict[str, Any]], Exception]]:
+        """Run _request_paper_analysis over several (prompt text, token count) pairs in packed requests.
+
+        Results come back in input order; papers in a failed request yield its exception.
+        """
+        results: List[Union[Optional[Dict[str, Any]], Exception]] = [None] * len(prompts)
+        
+        # Group the papers so each request stays under the token and paper limits
+        groups, group, group_tokens = [], [], 0
+        for i, (_, tokens) in enumerate(prompts):
+            if group and (group_tokens + tokens > BATCH_MAX_TOKENS or len(group) >= BATCH_MAX_PAPERS):
+                groups.append(group)
+                group, group_tokens = [], 0
+            group.append(i)
+            group_tokens += tokens
+        if group:
+            groups.append(group)
+        
+        group_results = await asyncio.gather(
+            *[self._analyze_paper_group([prompts[i][0] for i in group]) for group in groups],
+            return_exceptions=True
+        )
+        
+        retry_individually = []
+        for group, analyses in zip(groups, group_results):
+            for position, i in enumerate(group):
+                if isinstance(analyses, Exception):
+                    results[i] = analyses
+                elif analyses[position] is None:
+                    retry_individually.append(i)
+                else:
+                    results[i] = analyses[position]
+        
+        # Papers the packed request could not handle are analyzed on their own
+        individual = await asyncio.gather(
+            *[self._request_paper_analysis(prompts[i][0]) for i in retry_individually],
+            return_exceptions=True
+        )
+        for i, analysis in zip(retry_individually, individual):
+            results[i] = analysis
+        
+        return results
+
+    async def _analyze_paper_group(self, texts: List[str]) -> List[Optional[Dict[str, Any]]]:
+        """Analyze several papers in one request; None marks a paper that needs its own request"""
+        if len(texts) == 1:
+            return [None]
+        
+        papers = "\n\n".join(f"### PAPER {i}\n{text}" for i, text in enumerate(texts, start=1))
+        try:
+            completion = await self._create_completion(
+                model=self.openai_model,
+                response_format=_PAPER_BATCH_FORMAT,
+                messages=[
+                    {"role": "system", "content": _PAPER_BATCH_SYSTEM},
+                    {"role": "user", "content": f"Analyze each of these {len(texts)} academic papers and provide a detailed assessment. Extract all available information for each field. If any field cannot be determined from the text, mark it as 'Not specified in text':\n\n{papers}"}
+                ]
+            )
+        except BadRequestError as e:
+            if e.code == "context_length_exceeded":
+                return [None] * len(texts)
+            raise Exception(f"OpenAI analysis error: {str(e)}")
+        except Exception as e:
+            raise Exception(f"OpenAI analysis error: {str(e)}")
+        
+        try:
+            analyses = orjson.loads(completion.choices[0].message.content).get("results")
+        except (orjson.JSONDecodeError, AttributeError):
+            analyses = None
+        if (not isinstance(analyses, list) or len(analyses) != len(texts)
+                or not all(isinstance(analysis, dict) for analysis in analyses)):
+            logger.warning("Batched paper analysis returned an unexpected shape, analyzing papers individually")
+            return [None] * len(texts)
+        return analyses
+
+    def _analysis_requests(self):
+        """Request runner for each paper_analyses column"""
+        return {
+            "paper": self._request_paper_analysis,
+            "citations": self._request_citation_analysis,
+            "gaps": self._request_gap_analysis
+        }
+
+    async def analyze_all(self, text_content: str) -> Tuple[Dict[str, Any], Dict[str, Any], Dict[str, Any]]:
+        """Run the paper, citation and research gap analyses concurrently"""
+        content_hash = _content_hash(text_content, self.openai_model)
+        analyses = await self._get_cached_analyses(content_hash, _ANALYSIS_COLUMNS)
+        missing = [column for column in _ANALYSIS_COLUMNS if analyses.get(column) is None]
+        
+        if missing:
+            # Tokenize the text once for all three requests, and off the event loop
+            prompt_text = await asyncio.to_thread(_truncate, text_content, ANALYSIS_MAX_TOKENS)
+            requests = self._analysis_requests()
+            fresh = dict(zip(missing, await asyncio.gather(*[requests[column](prompt_text) for column in missing])))
+            parsed = {column: analysis for column, analysis in fresh.items() if analysis is not None}
+            if parsed:
+                await self._store_analyses(content_hash, parsed)
+            for column, analysis in fresh.items():
+                analyses[column] = orjson.loads(_FALLBACKS_JSON[column]) if analysis is None else analysis
+        
+        return analyses["paper"], analyses["citations"], analyses["gaps"]
+
     async def extract_text(self, image_path: str) -> str:
         """Extract text from image using OpenAI's vision capabilities"""
         try:
             with open(image_path, "rb") as image_file:
-                image_data = image_file.read()
+                # Encode straight into the data URL so the raw bytes are not kept around
+                image_url = "data:image/jpeg;base64," + base64.b64encode(image_file.read()).decode('ascii')
                 
-            completion = self.openai_client.chat.completions.create(
-                model=self.openai_model,
+            completion = await self._create_completion(
+                model=self.openai_extract_model,
                 messages=[
                     {
                         "role": "system",
@@ -376,7 +712,7 @@ class AnalysisService:
                             {
                                 "type": "image_url",
                                 "image_url": {
-                                    "url": f"data:image/jpeg;base64,{base64.b64encode(image_data).decode('utf-8')}"
+                                    "url": image_url
                                 }
                             },
                             {
@@ -392,4 +728,9 @@ class AnalysisService:
             return completion.choices[0].message.content
 
         except Exception as e:
-            raise Exception(f"OpenAI OCR error: {str(e)}") 
\ No newline at end of file
+            raise Exception(f"OpenAI OCR error: {str(e)}")
+
+@lru_cache(maxsize=1)
+def get_analysis_service() -> AnalysisService:
+    """Return the process-wide AnalysisService, so its HTTP clients and connection pools are shared"""
+    return AnalysisService()
@@ -1,9 +1,66 @@
 import os
+import asyncio
+import logging
+from functools import lru_cache
+from typing import BinaryIO, List, Optional, Tuple, Union
 from mistralai.client import MistralClient
 import base64
 from PIL import Image
 import io
-import PyPDF2
+import uuid
+import multiprocessing
+import pypdf
+from concurrent.futures import ProcessPoolExecutor
+from supabase_client import get_supabase
+
+logger = logging.getLogger(__name__)
+
+# Images larger than this are handed to Mistral as a signed Storage URL instead of inline base64
+INLINE_IMAGE_MAX_BYTES = 1 << 20
+
+# Supabase Storage bucket that holds large images while they are being transcribed
+# (created in schema.sql; if it is unavailable, images are sent inline instead)
+OCR_TMP_BUCKET = os.getenv("OCR_TMP_BUCKET", "ocr-tmp")
+SIGNED_URL_EXPIRES_SECONDS = 300
+
+# PDFs with fewer pages than this are extracted in-process; shipping them to workers costs more
+PARALLEL_PDF_MIN_PAGES = 8
+
+# Number of leading pages checked for a text layer before extracting the whole PDF
+SCANNED_PROBE_PAGES = 2
+
+# Process pool for CPU-bound PDF text extraction, created on first use
+_pdf_pool = None
+
+def _get_pdf_pool() -> ProcessPoolExecutor:
+    global _pdf_pool
+    if _pdf_pool is None:
+        # By now the server has to_thread and httpx threads running, and forking a multithreaded
+        # process can deadlock the children on locks held at fork time; start fresh interpreters
+        _pdf_pool = ProcessPoolExecutor(mp_context=multiprocessing.get_context("spawn"))
+    return _pdf_pool
+
+def _extract_pages(pdf_content: bytes, start: int, stop: int) -> List[str]:
+    """Extract text from pages [start, stop) of a PDF (runs in a worker process)"""
+    pdf_reader = pypdf.PdfReader(io.BytesIO(pdf_content))
+    return [pdf_reader.pages[i].extract_text() for i in range(start, stop)]
+
+def _read_pdf(pdf_file: BinaryIO) -> Tuple[int, Optional[List[str]], Optional[bytes]]:
+    """Open a PDF and return its page count, page texts and raw bytes (runs in a thread).
+
+    Small PDFs are extracted right away and come back without their bytes;
+    large ones come back with the bytes for the process pool instead.
+    """
+    pdf_reader = pypdf.PdfReader(pdf_file)
+    num_pages = len(pdf_reader.pages)
+    # A PDF whose first pages have no text layer is treated as scanned; don't extract the rest
+    probe_texts = [pdf_reader.pages[i].extract_text() for i in range(min(SCANNED_PROBE_PAGES, num_pages))]
+    if not any(text.strip() for text in probe_texts):
+        return num_pages, [], None
+    if num_pages < PARALLEL_PDF_MIN_PAGES:
+        return num_pages, probe_texts + [pdf_reader.pages[i].extract_text() for i in range(len(probe_texts), num_pages)], None
+    pdf_file.seek(0)
+    return num_pages, None, pdf_file.read()
 
 class OCRService:
     def __init__(self):
@@ -12,42 +69,64 @@ class OCRService:
             raise ValueError("MISTRAL_API_KEY not found in environment variables")
         self.client = MistralClient(api_key=api_key)
         self.model = "mistral-large-latest"
+        # Plain transcription does not need the large model
+        self.ocr_model = "mistral-small-latest"
 
-    def encode_image_to_base64(self, image_bytes: bytes, content_type: str) -> str:
-        """Convert image bytes to base64 string"""
-        return base64.b64encode(image_bytes).decode('utf-8')
+        # Cap in-flight Mistral requests to stay under its rate limits
+        self._mistral_sem = asyncio.Semaphore(4)
 
     async def extract_text(self, content: bytes, content_type: str) -> str:
         """Extract text from image/PDF using Mistral's vision capabilities"""
+        return await self.extract_text_stream(io.BytesIO(content), content_type)
+
+    async def extract_text_stream(self, file_like: BinaryIO, content_type: str) -> str:
+        """Extract text from a file-like object without reading it into memory up front"""
         try:
             # Special case for text files - just return the content
             if content_type == 'text/plain':
-                return content.decode('utf-8', errors='ignore')
+                return await asyncio.to_thread(lambda: file_like.read().decode('utf-8', errors='ignore'))
                     
-            # For PDF files, use PyPDF2
+            # For PDF files, use pypdf (it reads pages from the stream on demand)
             if content_type == 'application/pdf':
-                return self._extract_text_from_pdf(content)
+                return await self._extract_text_from_pdf(file_like)
                 
             # For images, use Mistral's vision capabilities
-            return await self._process_image(content, content_type)
+            return await self._process_image(file_like, content_type)
                 
         except Exception as e:
             raise Exception(f"Text extraction error: {str(e)}")
 
-    def _extract_text_from_pdf(self, pdf_content: bytes) -> str:
-        """Extract text from PDF using PyPDF2"""
+    async def extract_text_batch(self, items: List[Tuple[BinaryIO, str]]) -> List[Union[str, Exception]]:
+        """Extract text from several (file_like, content_type) items in one call.
+
+        Results come back in input order; a failed item yields its exception
+        instead of aborting the whole batch.
+        """
+        return await asyncio.gather(
+            *[self.extract_text_stream(file_like, content_type) for file_like, content_type in items],
+            return_exceptions=True
+        )
+
+    async def _extract_text_from_pdf(self, pdf_file: BinaryIO) -> str:
+        """Extract text from PDF using pypdf, spreading large documents across processes"""
         try:
-            # Create a file-like object from bytes
-            pdf_file = io.BytesIO(pdf_content)
+            # Parsing the PDF and reading it back are blocking; keep them off the event loop
+            num_pages, page_texts, pdf_content = await asyncio.to_thread(_read_pdf, pdf_file)
             
-            # Create PDF reader object
-            pdf_reader = PyPDF2.PdfReader(pdf_file)
+            if page_texts is None:
+                # Each worker reopens the PDF and extracts one contiguous range of pages,
+                # so the document is pickled once per worker rather than once per page
+                pages_per_worker = -(-num_pages // (os.cpu_count() or 1))
+                loop = asyncio.get_running_loop()
+                page_ranges = await asyncio.gather(*[
+                    loop.run_in_executor(
+                        _get_pdf_pool(), _extract_pages, pdf_content, start, min(start + pages_per_worker, num_pages)
+                    )
+                    for start in range(0, num_pages, pages_per_worker)
+                ])
+                page_texts = [page_text for page_range in page_ranges for page_text in page_range]
             
-            # Extract text from all pages
-            text = ""
-            for page_num in range(len(pdf_reader.pages)):
-                page = pdf_reader.pages[page_num]
-                text += page.extract_text() + "\n\n"
+            text = "\n\n".join(page_texts)
             
             if not text.strip():
                 # If no text was extracted, the PDF might be scanned
@@ -55,23 +134,54 @@ class OCRService:
                 
             return text
         except Exception as e:
+            logger.warning("Error extracting text from PDF: %s", e)
             return f"Error extracting text from PDF: {str(e)}"
 
-    async def _process_image(self, image_bytes: bytes, content_type: str) -> str:
+    async def _process_image(self, image_file: BinaryIO, content_type: str) -> str:
         """Process a single image using Mistral"""
-        base64_image = self.encode_image_to_base64(image_bytes, content_type)
+        image_bytes = await asyncio.to_thread(image_file.read)
+        
+        if len(image_bytes) > INLINE_IMAGE_MAX_BYTES:
+            # Large images: upload once and let Mistral fetch them, avoiding the 33% base64 bloat
+            path = str(uuid.uuid4())
+            try:
+                signed_url = await self._stage_image(path, image_bytes, content_type)
+                if signed_url is not None:
+                    return await self._transcribe_image(signed_url)
+            finally:
+                await self._unstage_image(path)
         
+        # Small images, or Storage is unavailable: send the image inline (ascii decode is cheaper than utf-8)
+        return await self._transcribe_image(f"data:{content_type};base64," + base64.b64encode(image_bytes).decode('ascii'))
+
+    async def _stage_image(self, path: str, image_bytes: bytes, content_type: str) -> Optional[str]:
+        """Upload an image to the OCR bucket and return a signed URL for it, or None if that fails"""
+        try:
+            bucket = get_supabase().storage.from_(OCR_TMP_BUCKET)
+            await asyncio.to_thread(bucket.upload, path, image_bytes, {"content-type": content_type})
+            signed = await asyncio.to_thread(bucket.create_signed_url, path, SIGNED_URL_EXPIRES_SECONDS)
+            return signed["signedURL"]
+        except Exception as e:
+            logger.warning("Could not stage image in bucket %s, sending it inline: %s", OCR_TMP_BUCKET, e)
+            return None
+
+    async def _unstage_image(self, path: str) -> None:
+        """Remove a staged image; a leftover object is only logged"""
+        try:
+            bucket = get_supabase().storage.from_(OCR_TMP_BUCKET)
+            await asyncio.to_thread(bucket.remove, [path])
+        except Exception as e:
+            logger.warning("Could not remove temporary OCR image %s: %s", path, e)
+
+    async def _transcribe_image(self, image_url: str) -> str:
+        """Ask Mistral to transcribe the image at image_url (a data URL or a signed URL)"""
         messages = [
             {
                 "role": "user",
                 "content": [
                     {
-                        "type": "image",
-                        "source": {
-                            "type": "base64",
-                            "media_type": content_type,
-                            "data": base64_image
-                        }
+                        "type": "image_url",
+                        "image_url": {"url": image_url}
                     },
                     {
                         "type": "text",
@@ -81,10 +191,13 @@ class OCRService:
             }
         ]
 
-        response = self.client.chat.complete(
-            model=self.model,
-            messages=messages
-        )
+        async with self._mistral_sem:
+            # The Mistral client is synchronous; keep it off the event loop
+            response = await asyncio.to_thread(
+                self.client.chat.complete,
+                model=self.ocr_model,
+                messages=messages
+            )
         return response.choices[0].message.content
 
     async def analyze_text(self, text_content: str) -> str:
@@ -115,4 +228,9 @@ class OCRService:
             )
             return response.choices[0].message.content
         except Exception as e:
-            raise Exception(f"Mistral analysis error: {str(e)}") 
\ No newline at end of file
+            raise Exception(f"Mistral analysis error: {str(e)}")
+
+@lru_cache(maxsize=1)
+def get_ocr_service() -> OCRService:
+    """Return the process-wide OCRService, so its HTTP clients and connection pools are shared"""
+    return OCRService()
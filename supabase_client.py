@@ -1,5 +1,6 @@
-from supabase import create_client
+from supabase import create_client, Client
 import os
+import functools
 from dotenv import load_dotenv
 import logging
 
@@ -10,28 +11,38 @@ logger = logging.getLogger(__name__)
 # Load environment variables from .env file (works in local development)
 load_dotenv()
 
-# Get environment variables with better error handling
-supabase_url = os.getenv("SUPABASE_URL")
-supabase_key = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
-
-# Log information for debugging (not the actual key)
-logger.info(f"Supabase URL: {supabase_url}")
-logger.info(f"Supabase key available: {bool(supabase_key)}")
-
-# Validate environment variables
-if not supabase_url:
-    logger.error("SUPABASE_URL environment variable is not set")
-    supabase_url = "https://otkckrxodedjkipgnnqf.supabase.co"  # Fallback value
-    logger.info(f"Using fallback SUPABASE_URL: {supabase_url}")
-
-if not supabase_key:
-    logger.error("SUPABASE_SERVICE_ROLE_KEY environment variable is not set")
-    raise ValueError("SUPABASE_SERVICE_ROLE_KEY environment variable is not set. This is required to connect to Supabase.")
-
-try:
-    # Create the client with proper error handling
-    supabase = create_client(supabase_url, supabase_key)
-    logger.info("Supabase client created successfully")
-except Exception as e:
-    logger.error(f"Error creating Supabase client: {str(e)}")
-    raise 
\ No newline at end of file
+@functools.cache
+def get_supabase() -> Client:
+    """Create the process-wide Supabase client on first use"""
+    # Get environment variables with better error handling
+    supabase_url = os.getenv("SUPABASE_URL")
+    supabase_key = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+
+    # Log information for debugging (not the actual key)
+    logger.info("Supabase URL: %s", supabase_url)
+    logger.info("Supabase key available: %s", bool(supabase_key))
+
+    # Validate environment variables
+    if not supabase_url:
+        logger.error("SUPABASE_URL environment variable is not set")
+        supabase_url = "https://otkckrxodedjkipgnnqf.supabase.co"  # Fallback value
+        logger.info("Using fallback SUPABASE_URL: %s", supabase_url)
+
+    if not supabase_key:
+        logger.error("SUPABASE_SERVICE_ROLE_KEY environment variable is not set")
+        raise ValueError("SUPABASE_SERVICE_ROLE_KEY environment variable is not set. This is required to connect to Supabase.")
+
+    try:
+        # Create the client with proper error handling
+        client = create_client(supabase_url, supabase_key)
+        logger.info("Supabase client created successfully")
+        return client
+    except Exception as e:
+        logger.error("Error creating Supabase client: %s", e)
+        raise
+
+def __getattr__(name: str):
+    # Keeps `from supabase_client import supabase` working; the client is built on first access
+    if name == "supabase":
+        return get_supabase()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,5 +1,7 @@
 import os
-import requests
+import sys
+import asyncio
+import httpx
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -7,8 +9,24 @@ load_dotenv()
 API_URL = "http://localhost:8000"
 API_KEY = os.getenv("MISTRAL_API_KEY")
 
-def test_analyze_paper():
-    """Test the paper analysis endpoint with a sample PDF."""
+async def analyze_file(client, path, headers):
+    """Send one PDF to the paper analysis endpoint and print the outcome."""
+    with open(path, "rb") as f:
+        files = {"file": (os.path.basename(path), f.read(), "application/pdf")}
+    
+    response = await client.post("/api/papers/analyze", headers=headers, files=files)
+    
+    # Print the status code and response
+    print(f"[{path}] Status code: {response.status_code}")
+    
+    if response.status_code == 200:
+        print(f"[{path}] Success!")
+        print(response.json())
+    else:
+        print(f"[{path}] Error: {response.text}")
+
+async def run_smoke(paths):
+    """Test the paper analysis endpoint with one or more sample PDFs."""
     
     # Check if API key exists
     if not API_KEY:
@@ -16,41 +34,27 @@ def test_analyze_paper():
         return
     
     # Path to a test PDF file
-    # Update this path to point to a valid PDF file on your system
+    # Pass other PDF paths on the command line to analyze several at once
     test_file_path = "test_document.pdf"
     
     # Check if the file exists
-    if not os.path.exists(test_file_path):
+    if not paths and not os.path.exists(test_file_path):
         with open(test_file_path, "w") as f:
             f.write("Test document content")
         print(f"Created test file: {test_file_path}")
+    paths = paths or [test_file_path]
+    
+    # Make the requests
+    print(f"Sending {len(paths)} request(s) to {API_URL}/api/papers/analyze")
+    print(f"API Key (first 5 chars): {API_KEY[:5]}...")
+    
+    headers = {
+        "Authorization": f"Bearer {API_KEY}"
+    }
     
-    # Open the file in binary mode
-    with open(test_file_path, "rb") as f:
-        files = {"file": (os.path.basename(test_file_path), f, "application/pdf")}
-        
-        # Make the request
-        print(f"Sending request to {API_URL}/api/papers/analyze")
-        print(f"API Key (first 5 chars): {API_KEY[:5]}...")
-        
-        headers = {
-            "Authorization": f"Bearer {API_KEY}"
-        }
-        
-        response = requests.post(
-            f"{API_URL}/api/papers/analyze",
-            headers=headers,
-            files=files
-        )
-        
-        # Print the status code and response
-        print(f"Status code: {response.status_code}")
-        
-        if response.status_code == 200:
-            print("Success!")
-            print(response.json())
-        else:
-            print(f"Error: {response.text}")
+    # One client so all requests share pooled keep-alive connections
+    async with httpx.AsyncClient(base_url=API_URL, timeout=120) as client:
+        await asyncio.gather(*[analyze_file(client, path, headers) for path in paths])
 
 if __name__ == "__main__":
-    test_analyze_paper() 
\ No newline at end of file
+    asyncio.run(run_smoke(sys.argv[1:]))
@@ -0,0 +1,55 @@
+from types import SimpleNamespace
+from fastapi.testclient import TestClient
+import main
+
+class FakeQuery:
+    """Just enough of a PostgREST query builder: inserts append, every other filter is ignored"""
+    def __init__(self, rows):
+        self.rows = rows
+        self.inserted = None
+
+    def insert(self, data):
+        self.inserted = data
+        return self
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self
+
+    def execute(self):
+        if self.inserted is not None:
+            self.rows.append(self.inserted)
+            return SimpleNamespace(data=[self.inserted])
+        return SimpleNamespace(data=list(self.rows))
+
+class FakeSupabase:
+    def __init__(self):
+        self.tables = {}
+
+    def table(self, name):
+        return FakeQuery(self.tables.setdefault(name, []))
+
+def test_write_invalidates_cached_list(monkeypatch):
+    monkeypatch.setattr(main, "supabase", FakeSupabase())
+    with TestClient(main.app) as client:
+        first = client.get("/api/theses/")
+        assert first.json() == []
+
+        created = client.post("/api/theses/", json={"title": "T", "content": "C"})
+        assert created.status_code == 200
+
+        second = client.get("/api/theses/")
+        assert [thesis["id"] for thesis in second.json()] == [created.json()["id"]]
+
+        # Browsers must not reuse a list the server has already invalidated
+        for response in (first, second):
+            assert response.headers["Cache-Control"] == "private, no-cache"
+
+def test_cached_response_is_revalidated_not_reused(monkeypatch):
+    monkeypatch.setattr(main, "supabase", FakeSupabase())
+    with TestClient(main.app) as client:
+        client.get("/api/theses/")
+        cached = client.get("/api/theses/")
+        assert cached.headers["Cache-Control"] == "private, no-cache"
+
+        revalidated = client.get("/api/theses/", headers={"If-None-Match": cached.headers["ETag"]})
+        assert revalidated.status_code == 304
@@ -0,0 +1,25 @@
+import os
+import httpx
+from fastapi.testclient import TestClient
+import main
+
+def capture_postgrest_requests(monkeypatch):
+    """Answer every PostgREST request with an empty list, recording the headers that were sent"""
+    sent = []
+
+    def request(method, path, **kwargs):
+        sent.append(kwargs["headers"])
+        return httpx.Response(200, json=[], request=httpx.Request(method, f"https://example.supabase.co{path}"))
+
+    monkeypatch.setattr(main.supabase.postgrest.session, "request", request)
+    return sent
+
+def test_pages_request_exactly_limit_rows(monkeypatch):
+    sent = capture_postgrest_requests(monkeypatch)
+    headers = {"Authorization": f"Bearer {os.environ['MISTRAL_API_KEY']}"}
+    with TestClient(main.app) as client:
+        client.get("/api/theses/?limit=50&offset=100")
+        client.get("/api/papers/?limit=1", headers=headers)
+        client.get("/api/papers/search/?limit=20&offset=40", headers=headers)
+
+    assert [request_headers["Range"] for request_headers in sent] == ["100-149", "0-0", "40-59"]